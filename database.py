@@ -1,16 +1,252 @@
+import atexit
+import logging
+import queue
 import sqlite3
+import threading
 import os
-from typing import Optional, List, Dict, Any
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Optional, List, Dict, Any
 from datetime import datetime
 
+# Statements are module constants so every call passes the same string and
+# hits the connection's prepared-statement cache.
+_SQL_MARK_PROCESSED = """
+    INSERT OR REPLACE INTO processed_messages 
+    (message_id, stream_id, topic, sender_id, timestamp, draft_created)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+# Upserts update the existing row in place instead of deleting and
+# re-inserting it as INSERT OR REPLACE does. draft_id and
+# last_drafted_message_id are only overwritten when the write supplies them, so status-only writes such as
+# check_open_conversations keep the thread's existing draft.
+_SQL_UPDATE_THREAD = """
+    INSERT INTO conversation_threads 
+    (thread_key, stream_id, topic, last_message_id, last_message_timestamp, 
+     needs_reply, last_checked, draft_id, last_drafted_message_id)
+    VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, ?, ?)
+    ON CONFLICT(thread_key) DO UPDATE SET
+        stream_id = excluded.stream_id,
+        topic = excluded.topic,
+        last_message_id = excluded.last_message_id,
+        last_message_timestamp = excluded.last_message_timestamp,
+        needs_reply = excluded.needs_reply,
+        last_checked = CURRENT_TIMESTAMP,
+        draft_id = COALESCE(excluded.draft_id, draft_id),
+        last_drafted_message_id = COALESCE(excluded.last_drafted_message_id,
+                                           last_drafted_message_id)
+"""
+
+_SQL_IS_PROCESSED = "SELECT 1 FROM processed_messages WHERE message_id = ?"
+
+_SQL_GET_THREAD = """
+    SELECT thread_key, stream_id, topic, last_message_id, 
+           last_message_timestamp, needs_reply, draft_id
+    FROM conversation_threads 
+    WHERE thread_key = ?
+"""
+
+_SQL_GET_THREAD_LAST_DRAFTED = """
+    SELECT last_drafted_message_id FROM conversation_threads WHERE thread_key = ?
+"""
+
+_SQL_THREADS_NEEDING_REPLY = """
+    SELECT thread_key, stream_id, topic, last_message_id, 
+           last_message_timestamp, draft_id
+    FROM conversation_threads 
+    WHERE needs_reply = 1
+    ORDER BY last_message_timestamp ASC
+"""
+
+_SQL_SET_STATE = """
+    INSERT INTO bot_state (key, value, updated_at)
+    VALUES (?, ?, CURRENT_TIMESTAMP)
+    ON CONFLICT(key) DO UPDATE SET
+        value = excluded.value,
+        updated_at = CURRENT_TIMESTAMP
+"""
+
+_SQL_GET_STATE = "SELECT value FROM bot_state WHERE key = ?"
+
+_SQL_GET_CACHED_RESPONSE = """
+    SELECT response FROM replies_cache
+    WHERE prompt_hash = ? AND created_at > datetime('now', ?)
+"""
+
+_SQL_SET_CACHED_RESPONSE = """
+    INSERT INTO replies_cache (prompt_hash, response, created_at)
+    VALUES (?, ?, CURRENT_TIMESTAMP)
+    ON CONFLICT(prompt_hash) DO UPDATE SET
+        response = excluded.response,
+        created_at = CURRENT_TIMESTAMP
+"""
+
+# Upper bound on message IDs remembered by the is_message_processed cache
+_PROCESSED_CACHE_SIZE = 10000
+
+# Queued by close() to stop the writer thread
+_STOP_WRITER = object()
+
 class BotDatabase:
     def __init__(self, db_path: str = "zulip_bot.db"):
         self.db_path = db_path
+        self.logger = logging.getLogger(__name__)
+        # Reads go through self._conn (serialized by self._lock). All writes
+        # are queued and applied by a single writer thread on its own
+        # connection, so concurrent callers never compete for the write lock.
+        self._conn = self._connect()
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        self._write_conn = self._connect()
+        self._write_queue: queue.Queue = queue.Queue()
+        # Errors from queued writes, raised by the next flush_sync()
+        self._write_errors: List[Exception] = []
+        # LRU of message IDs known to be processed. Processed is never unset,
+        # so entries cannot go stale.
+        self._processed_cache: 'OrderedDict[int, None]' = OrderedDict()
+        self._closed = False
         self.init_database()
+        self._writer = threading.Thread(target=self._writer_loop,
+                                        name="BotDatabase-writer", daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+    
+    def _connect(self) -> sqlite3.Connection:
+        """Open a tuned connection to the database file."""
+        conn = sqlite3.connect(self.db_path, check_same_thread=False,
+                               isolation_level=None, cached_statements=256)
+        # Connection tuning: WAL keeps readers from blocking the writer and
+        # lets commits skip most fsyncs. journal_mode persists in the file,
+        # the remaining pragmas only apply to this connection.
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-64000")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute("PRAGMA mmap_size=268435456")
+        return conn
+    
+    def close(self):
+        """Drain queued writes, stop the writer thread and close both connections."""
+        if self._closed:
+            return
+        self._closed = True
+        self._write_queue.put(_STOP_WRITER)
+        self._writer.join()
+        self._write_conn.close()
+        with self._lock:
+            self._conn.close()
+    
+    @contextmanager
+    def _transaction(self, conn: sqlite3.Connection):
+        """Run the enclosed statements in a single transaction.
+        
+        The connection is in autocommit mode (isolation_level=None), so this is
+        the only place transactions are opened. BEGIN IMMEDIATE takes the write
+        lock up front rather than upgrading a read lock mid-transaction. A
+        failed COMMIT is rolled back too, so the connection is never left
+        inside an open transaction.
+        """
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+    
+    def _writer_loop(self):
+        """Apply queued writes, committing everything queued so far as one transaction.
+        
+        Each write runs in its own savepoint, so a failing write is rolled back
+        on its own and the rest of the batch still commits. Failures are
+        recorded and raised by the next flush_sync(), and the loop keeps running
+        whatever the error; the on_commit callbacks of the writes that
+        succeeded run once the batch has committed.
+        """
+        conn = self._write_conn
+        while True:
+            batch = [self._write_queue.get()]
+            while True:
+                try:
+                    batch.append(self._write_queue.get_nowait())
+                except queue.Empty:
+                    break
+            
+            writes = [item for item in batch if item is not _STOP_WRITER]
+            errors = []
+            committed = []
+            try:
+                if writes:
+                    with self._transaction(conn):
+                        for sql, rows, on_commit in writes:
+                            conn.execute("SAVEPOINT queued_write")
+                            try:
+                                conn.executemany(sql, rows)
+                            except Exception as e:
+                                conn.execute("ROLLBACK TO queued_write")
+                                errors.append(e)
+                            else:
+                                if on_commit is not None:
+                                    committed.append(on_commit)
+                            conn.execute("RELEASE queued_write")
+            except Exception as e:
+                # The transaction itself failed (e.g. still busy after
+                # busy_timeout), so nothing from this batch was written
+                committed = []
+                errors.append(e)
+            
+            try:
+                for on_commit in committed:
+                    try:
+                        on_commit()
+                    except Exception as e:
+                        errors.append(e)
+            finally:
+                if errors:
+                    for e in errors:
+                        self.logger.error("Error writing to database: %s", e)
+                    with self._lock:
+                        self._write_errors.extend(errors)
+                for _ in batch:
+                    self._write_queue.task_done()
+            
+            if len(writes) != len(batch):
+                return
+    
+    def _enqueue(self, sql: str, rows: List[tuple],
+                 on_commit: Optional[Callable[[], None]] = None):
+        """Hand a write to the writer thread.
+        
+        on_commit is called from the writer thread once the write is committed.
+        """
+        if not rows:
+            return
+        if self._closed:
+            raise sqlite3.ProgrammingError("Cannot write to a closed database.")
+        self._write_queue.put((sql, rows, on_commit))
+    
+    def _wait_for_writes(self):
+        """Block until every queued write has been applied, so reads see them."""
+        self._write_queue.join()
+    
+    def flush_sync(self):
+        """Block until every queued write has been applied.
+        
+        Raises the first error from any write that failed since the last
+        call; the other writes in its batch are still committed.
+        """
+        self._wait_for_writes()
+        with self._lock:
+            errors, self._write_errors = self._write_errors, []
+        if errors:
+            raise errors[0]
     
     def init_database(self):
         """Initialize the database with required tables."""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._transaction(self._write_conn) as conn:
             cursor = conn.cursor()
             
             # Table to track processed messages
@@ -38,9 +274,27 @@ class BotDatabase:
                     last_message_timestamp DATETIME,
                     needs_reply BOOLEAN DEFAULT FALSE,
                     last_checked DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    draft_id INTEGER
+                    draft_id INTEGER,
+                    last_drafted_message_id INTEGER
                 )
             """)
+            # Columns added after the table was first released
+            if self._ensure_column(cursor, 'conversation_threads', 'last_drafted_message_id',
+                                   'INTEGER'):
+                # Rows with a draft were last written by the draft loop, so
+                # their last_message_id is the message the draft covered
+                cursor.execute("""
+                    UPDATE conversation_threads SET last_drafted_message_id = last_message_id
+                    WHERE draft_id IS NOT NULL
+                """)
+            
+            # get_threads_needing_reply filters on needs_reply and orders by
+            # timestamp; a partial index serves both without a table scan
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_threads_needs_reply
+                ON conversation_threads(last_message_timestamp)
+                WHERE needs_reply = 1
+            """)
             
             # Table to track bot state
             cursor.execute("""
@@ -51,90 +305,130 @@ class BotDatabase:
                 )
             """)
             
-            conn.commit()
+            # Table caching model responses by a hash of their inputs
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS replies_cache (
+                    prompt_hash TEXT PRIMARY KEY,
+                    response TEXT,
+                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+
+    def _ensure_column(self, cursor: sqlite3.Cursor, table: str, column: str,
+                       definition: str) -> bool:
+        """Add a column to an existing table if it is missing. Returns True if it was added."""
+        columns = {row[1] for row in cursor.execute(f"PRAGMA table_info({table})")}
+        if column in columns:
+            return False
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+        return True
+    
+    def _remember_processed(self, message_id: int):
+        """Record a processed message ID in the LRU. Caller must hold self._lock."""
+        cache = self._processed_cache
+        cache[message_id] = None
+        cache.move_to_end(message_id)
+        if len(cache) > _PROCESSED_CACHE_SIZE:
+            cache.popitem(last=False)
     
     def mark_message_processed(self, message_id: int, stream_id: Optional[int], 
                              topic: Optional[str], sender_id: int, timestamp: str, 
                              draft_created: bool = False):
-        """Mark a message as processed."""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                INSERT OR REPLACE INTO processed_messages 
-                (message_id, stream_id, topic, sender_id, timestamp, draft_created)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (message_id, stream_id, topic, sender_id, timestamp, draft_created))
-            conn.commit()
+        """Mark a message as processed. The write is applied by the writer thread."""
+        self.mark_messages_processed_bulk(
+            [(message_id, stream_id, topic, sender_id, timestamp, draft_created)])
+    
+    def mark_messages_processed_bulk(self, rows: List[tuple]):
+        """Mark many messages as processed in a single transaction.
+        
+        Each row is (message_id, stream_id, topic, sender_id, timestamp, draft_created).
+        """
+        rows = list(rows)
+        message_ids = [row[0] for row in rows]
+        
+        def remember_committed():
+            # Only cache IDs whose rows are actually stored
+            with self._lock:
+                for message_id in message_ids:
+                    self._remember_processed(message_id)
+        
+        self._enqueue(_SQL_MARK_PROCESSED, rows, on_commit=remember_committed)
     
     def is_message_processed(self, message_id: int) -> bool:
         """Check if a message has been processed."""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT 1 FROM processed_messages WHERE message_id = ?", (message_id,))
-            return cursor.fetchone() is not None
+        with self._lock:
+            if message_id in self._processed_cache:
+                self._processed_cache.move_to_end(message_id)
+                return True
+        self._wait_for_writes()
+        with self._lock:
+            cursor = self._conn.execute(_SQL_IS_PROCESSED, (message_id,))
+            if cursor.fetchone() is None:
+                return False
+            self._remember_processed(message_id)
+            return True
     
     def update_conversation_thread(self, thread_key: str, stream_id: Optional[int], 
                                  topic: Optional[str], last_message_id: int, 
                                  last_message_timestamp: str, needs_reply: bool = False,
-                                 draft_id: Optional[int] = None):
-        """Update or create a conversation thread record."""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                INSERT OR REPLACE INTO conversation_threads 
-                (thread_key, stream_id, topic, last_message_id, last_message_timestamp, 
-                 needs_reply, last_checked, draft_id)
-                VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, ?)
-            """, (thread_key, stream_id, topic, last_message_id, last_message_timestamp, 
-                  needs_reply, draft_id))
-            conn.commit()
+                                 draft_id: Optional[int] = None,
+                                 last_drafted_message_id: Optional[int] = None):
+        """Update or create a conversation thread record. The write is applied by the writer thread."""
+        self.update_conversation_threads_bulk(
+            [(thread_key, stream_id, topic, last_message_id, last_message_timestamp,
+              needs_reply, draft_id, last_drafted_message_id)])
+    
+    def update_conversation_threads_bulk(self, rows: List[tuple]):
+        """Update or create many conversation thread records in a single transaction.
+        
+        Each row is (thread_key, stream_id, topic, last_message_id,
+        last_message_timestamp, needs_reply, draft_id, last_drafted_message_id).
+        """
+        self._enqueue(_SQL_UPDATE_THREAD, list(rows))
     
     def get_conversation_thread(self, thread_key: str) -> Optional[Dict[str, Any]]:
         """Get conversation thread info by thread_key."""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT thread_key, stream_id, topic, last_message_id, 
-                       last_message_timestamp, needs_reply, draft_id
-                FROM conversation_threads 
-                WHERE thread_key = ?
-            """, (thread_key,))
-            
+        self._wait_for_writes()
+        with self._lock:
+            cursor = self._conn.execute(_SQL_GET_THREAD, (thread_key,))
             result = cursor.fetchone()
-            if result:
-                columns = [desc[0] for desc in cursor.description]
-                return dict(zip(columns, result))
-            return None
+            return dict(result) if result else None
 
+    def get_thread_last_drafted_message_id(self, thread_key: str) -> Optional[int]:
+        """Get the ID of the newest message covered by the thread's draft, if any."""
+        self._wait_for_writes()
+        with self._lock:
+            result = self._conn.execute(_SQL_GET_THREAD_LAST_DRAFTED, (thread_key,)).fetchone()
+            return result[0] if result else None
+    
     def get_threads_needing_reply(self) -> List[Dict[str, Any]]:
         """Get all conversation threads that need a reply."""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT thread_key, stream_id, topic, last_message_id, 
-                       last_message_timestamp, draft_id
-                FROM conversation_threads 
-                WHERE needs_reply = TRUE
-                ORDER BY last_message_timestamp ASC
-            """)
-            
-            columns = [desc[0] for desc in cursor.description]
-            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+        self._wait_for_writes()
+        with self._lock:
+            cursor = self._conn.execute(_SQL_THREADS_NEEDING_REPLY)
+            return [dict(row) for row in cursor.fetchall()]
     
     def set_bot_state(self, key: str, value: str):
-        """Set a bot state value."""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                INSERT OR REPLACE INTO bot_state (key, value, updated_at)
-                VALUES (?, ?, CURRENT_TIMESTAMP)
-            """, (key, value))
-            conn.commit()
+        """Set a bot state value. The write is applied by the writer thread."""
+        self._enqueue(_SQL_SET_STATE, [(key, value)])
     
     def get_bot_state(self, key: str, default: Optional[str] = None) -> Optional[str]:
         """Get a bot state value."""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT value FROM bot_state WHERE key = ?", (key,))
+        self._wait_for_writes()
+        with self._lock:
+            cursor = self._conn.execute(_SQL_GET_STATE, (key,))
             result = cursor.fetchone()
-            return result[0] if result else default
\ No newline at end of file
+            return result[0] if result else default
+    
+    def get_cached_response(self, prompt_hash: str, max_age_seconds: int = 86400) -> Optional[str]:
+        """Get a cached model response by hash, if younger than max_age_seconds."""
+        self._wait_for_writes()
+        with self._lock:
+            cursor = self._conn.execute(_SQL_GET_CACHED_RESPONSE,
+                                        (prompt_hash, f"-{max_age_seconds} seconds"))
+            result = cursor.fetchone()
+            return result[0] if result else None
+    
+    def set_cached_response(self, prompt_hash: str, response: str):
+        """Cache a model response by hash. The write is applied by the writer thread."""
+        self._enqueue(_SQL_SET_CACHED_RESPONSE, [(prompt_hash, response)])
\ No newline at end of file
@@ -3,49 +3,62 @@
 import os
 import sys
 import logging
+import logging.handlers
 import click
-from typing import Optional
+from typing import Optional, TYPE_CHECKING
 from dotenv import load_dotenv
 
-from zulip_bot import ZulipBot
+if TYPE_CHECKING:
+    from zulip_bot import ZulipBot
 
 # Load environment variables
 load_dotenv()
 
 def setup_logging(verbose: bool = False):
     """Setup logging configuration."""
+    # Already configured in this process; don't open another log file handle
+    if logging.getLogger().handlers:
+        return
+    
     level = logging.DEBUG if verbose else logging.INFO
     logging.basicConfig(
         level=level,
         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
         handlers=[
-            logging.FileHandler('zulip_bot.log'),
+            logging.handlers.RotatingFileHandler('zulip_bot.log', maxBytes=10_000_000, backupCount=3),
             logging.StreamHandler(sys.stdout)
         ]
     )
 
-def get_bot_instance(channel_filter: Optional[str] = None) -> ZulipBot:
+def get_bot_instance(channel_filter: Optional[str] = None) -> 'ZulipBot':
     """Create and return a ZulipBot instance with environment configuration."""
-    required_env_vars = [
+    env = os.environ
+    required_env_vars = (
         'ZULIP_EMAIL', 'ZULIP_API_KEY', 'ZULIP_SITE',
         'GOOGLE_CLOUD_PROJECT', 'GOOGLE_CLOUD_LOCATION'
-    ]
+    )
     
-    missing_vars = [var for var in required_env_vars if not os.getenv(var)]
+    missing_vars = [var for var in required_env_vars if not env.get(var)]
     if missing_vars:
         click.echo(f"Error: Missing required environment variables: {', '.join(missing_vars)}")
         click.echo("Please check your .env file or set these variables.")
         sys.exit(1)
     
+    # Imported lazily: it pulls in the Zulip and Vertex AI SDKs, which `setup`
+    # and `--help` don't need
+    from zulip_bot import ZulipBot
+    
     return ZulipBot(
-        zulip_email=os.getenv('ZULIP_EMAIL'),
-        zulip_api_key=os.getenv('ZULIP_API_KEY'),
-        zulip_site=os.getenv('ZULIP_SITE'),
-        gcp_project=os.getenv('GOOGLE_CLOUD_PROJECT'),
-        gcp_location=os.getenv('GOOGLE_CLOUD_LOCATION'),
-        vertex_model=os.getenv('VERTEX_AI_MODEL', 'gemini-1.5-pro'),
-        style_instructions=os.getenv('BOT_STYLE_INSTRUCTIONS'),
-        channel_filter=channel_filter
+        zulip_email=env['ZULIP_EMAIL'],
+        zulip_api_key=env['ZULIP_API_KEY'],
+        zulip_site=env['ZULIP_SITE'],
+        gcp_project=env['GOOGLE_CLOUD_PROJECT'],
+        gcp_location=env['GOOGLE_CLOUD_LOCATION'],
+        vertex_model=env.get('VERTEX_AI_MODEL', 'gemini-1.5-pro'),
+        style_instructions=env.get('BOT_STYLE_INSTRUCTIONS'),
+        channel_filter=channel_filter,
+        vertex_concurrency=int(env.get('VERTEX_CONCURRENCY', '8')),
+        draft_only_when_needed=env.get('BOT_DRAFT_ONLY_WHEN_NEEDED', 'true').lower() != 'false'
     )
 
 @click.group()
@@ -1,16 +1,59 @@
-import vertexai
-from vertexai.generative_models import GenerativeModel, Part
+import hashlib
+import io
 import logging
-from typing import List, Dict, Any, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Dict, Any, Optional, Tuple
+
+from database import BotDatabase
+
+_REPLY_PROMPT_TEMPLATE = """You are an AI assistant helping {user_name} draft replies for Zulip messages. 
+
+Context: This is a {conversation_type} conversation.
+
+Conversation history:
+{conversation_context}
+
+Please draft a thoughtful and appropriate reply as {user_name}. The reply should:
+1. Be contextually appropriate and address the main points or questions raised
+2. Match the tone of the conversation
+3. Use {user_name}'s voice and perspective
+4. Follow these style guidelines: {style_instructions}
+
+Only provide the reply text, no additional formatting or explanations."""
+
+_SUMMARY_PROMPT_TEMPLATE = """You are an AI assistant helping {user_name} get a summary of unread Zulip messages.
+
+Here are the unread messages:
+
+{message_text}
+
+Please provide a concise summary that includes:
+1. Key topics or discussions
+2. Important questions or requests directed at {user_name}
+3. Any urgent or time-sensitive items
+4. A brief overview of what's happening in different conversations
+
+Format the summary in a clear, organized way that helps {user_name} quickly understand what needs attention."""
 
 class VertexAIClient:
     def __init__(self, project_id: str, location: str, model_name: str = "gemini-1.5-pro", 
-                 style_instructions: Optional[str] = None):
+                 style_instructions: Optional[str] = None,
+                 cache: Optional[BotDatabase] = None, cache_ttl: int = 24 * 60 * 60,
+                 max_concurrency: int = 8):
         self.project_id = project_id
         self.location = location
         self.model_name = model_name
         self.style_instructions = style_instructions or "Write in a professional and helpful tone."
         self.logger = logging.getLogger(__name__)
+        # Responses are cached by prompt hash so identical prompts skip the API call
+        self.cache = cache
+        self.cache_ttl = cache_ttl
+        # Upper bound on concurrent requests issued by generate_replies_batch
+        self.max_concurrency = max(1, max_concurrency)
+        
+        # Imported here so CLI commands that never reach Vertex AI skip the SDK import
+        import vertexai
+        from vertexai.generative_models import GenerativeModel
         
         # Initialize Vertex AI
         vertexai.init(project=project_id, location=location)
@@ -20,113 +63,143 @@ class VertexAIClient:
                       conversation_type: str = "stream") -> Optional[str]:
         """Generate a reply based on conversation context."""
         try:
-            prompt = self._build_reply_prompt(conversation_context, user_name, conversation_type)
-            
-            response = self.model.generate_content(prompt)
+            # Keyed on the inputs rather than the prompt so a cache hit skips
+            # building the prompt as well as the API call
+            cache_key = self._reply_cache_key(conversation_context, user_name, conversation_type)
+            reply = self._generate_content(
+                cache_key,
+                lambda: self._build_reply_prompt(conversation_context, user_name, conversation_type)
+            )
             
-            if response and response.text:
-                return response.text.strip()
+            if reply:
+                return reply
             else:
                 self.logger.error("No response generated from Vertex AI")
                 return None
                 
         except Exception as e:
-            self.logger.error(f"Error generating reply: {e}")
+            self.logger.error("Error generating reply: %s", e)
             return None
     
+    def generate_replies_batch(self, contexts: List[Tuple[str, str, str]]) -> List[Optional[str]]:
+        """Generate replies for many (conversation_context, user_name, conversation_type) tuples concurrently.
+        
+        Results are returned in input order; failed generations are None.
+        """
+        if not contexts:
+            return []
+        
+        workers = min(self.max_concurrency, len(contexts))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(lambda args: self.generate_reply(*args), contexts))
+    
     def generate_summary(self, messages: List[Dict[str, Any]], 
                         user_name: str) -> Optional[str]:
         """Generate a summary of unread messages."""
         try:
             prompt = self._build_summary_prompt(messages, user_name)
             
-            response = self.model.generate_content(prompt)
+            summary = self._generate_content(hashlib.sha256(prompt.encode()).hexdigest(),
+                                             lambda: prompt)
             
-            if response and response.text:
-                return response.text.strip()
+            if summary:
+                return summary
             else:
                 self.logger.error("No summary generated from Vertex AI")
                 return None
                 
         except Exception as e:
-            self.logger.error(f"Error generating summary: {e}")
+            self.logger.error("Error generating summary: %s", e)
             return None
     
+    def _reply_cache_key(self, conversation_context: str, user_name: str,
+                         conversation_type: str) -> str:
+        """Cache key for a reply: everything that goes into the reply prompt."""
+        key_material = "\0".join((conversation_context, user_name, conversation_type,
+                                  self.style_instructions))
+        return hashlib.sha256(key_material.encode()).hexdigest()[:32]
+    
+    def _generate_content(self, cache_key: str, build_prompt: Callable[[], str]) -> Optional[str]:
+        """Run a prompt through the model, serving repeats of cache_key from the cache.
+        
+        build_prompt is only called on a cache miss.
+        """
+        if self.cache:
+            cached = self.cache.get_cached_response(cache_key, self.cache_ttl)
+            if cached is not None:
+                self.logger.debug("Using cached Vertex AI response for %s", cache_key[:12])
+                return cached
+        
+        response = self.model.generate_content(build_prompt())
+        if not response or not response.text:
+            return None
+        
+        text = response.text.strip()
+        if self.cache and text:
+            self.cache.set_cached_response(cache_key, text)
+        return text
+    
     def _build_reply_prompt(self, conversation_context: str, user_name: str, 
                            conversation_type: str) -> str:
         """Build a prompt for generating replies."""
-        base_prompt = f"""You are an AI assistant helping {user_name} draft replies for Zulip messages. 
-
-Context: This is a {"stream/channel" if conversation_type == "stream" else "private"} conversation.
-
-Conversation history:
-{conversation_context}
-
-Please draft a thoughtful and appropriate reply as {user_name}. The reply should:
-1. Be contextually appropriate and address the main points or questions raised
-2. Match the tone of the conversation
-3. Use {user_name}'s voice and perspective
-4. Follow these style guidelines: {self.style_instructions}
-
-Only provide the reply text, no additional formatting or explanations."""
-
-        return base_prompt
+        return _REPLY_PROMPT_TEMPLATE.format_map({
+            'user_name': user_name,
+            'conversation_type': "stream/channel" if conversation_type == "stream" else "private",
+            'conversation_context': conversation_context,
+            'style_instructions': self.style_instructions,
+        })
     
     def _build_summary_prompt(self, messages: List[Dict[str, Any]], user_name: str) -> str:
         """Build a prompt for generating message summaries."""
-        message_text = self._format_messages_for_summary(messages)
-        
-        prompt = f"""You are an AI assistant helping {user_name} get a summary of unread Zulip messages.
-
-Here are the unread messages:
-
-{message_text}
-
-Please provide a concise summary that includes:
-1. Key topics or discussions
-2. Important questions or requests directed at {user_name}
-3. Any urgent or time-sensitive items
-4. A brief overview of what's happening in different conversations
-
-Format the summary in a clear, organized way that helps {user_name} quickly understand what needs attention."""
-
-        return prompt
+        return _SUMMARY_PROMPT_TEMPLATE.format_map({
+            'user_name': user_name,
+            'message_text': self._format_messages_for_summary(messages),
+        })
     
     def _format_messages_for_summary(self, messages: List[Dict[str, Any]]) -> str:
         """Format messages for summary generation."""
-        formatted_messages = []
+        buf = io.StringIO()
+        separator = ""
+        # Summaries usually cover a handful of conversations, so build each
+        # location string once per stream/topic or recipient set
+        location_cache: Dict[Any, str] = {}
         
         for msg in messages:
-            timestamp = msg.get('timestamp', 'Unknown time')
-            sender = msg.get('sender_full_name', 'Unknown sender')
-            content = msg.get('content', '')
+            get = msg.get
             
             # Include stream/topic info if available
-            location = ""
             if 'stream_id' in msg and 'subject' in msg:
-                location = f" in #{msg.get('display_recipient', 'unknown')} > {msg.get('subject', 'unknown topic')}"
-            elif msg.get('type') == 'private':
-                recipients = msg.get('display_recipient', [])
-                if isinstance(recipients, list):
-                    recipient_names = [r.get('full_name', 'Unknown') for r in recipients]
-                    location = f" (private message with {', '.join(recipient_names)})"
+                key = ('stream', msg['stream_id'], msg['subject'])
+                location = location_cache.get(key)
+                if location is None:
+                    location = f" in #{get('display_recipient', 'unknown')} > {msg['subject']}"
+                    location_cache[key] = location
+            elif get('type') == 'private' and isinstance(get('display_recipient'), list):
+                recipients = msg['display_recipient']
+                key = ('private',) + tuple(r.get('id') for r in recipients)
+                location = location_cache.get(key)
+                if location is None:
+                    recipient_names = ", ".join(r.get('full_name', 'Unknown') for r in recipients)
+                    location = f" (private message with {recipient_names})"
+                    location_cache[key] = location
+            else:
+                location = ""
             
-            formatted_messages.append(f"[{timestamp}] {sender}{location}: {content}")
+            buf.write(f"{separator}[{get('timestamp', 'Unknown time')}] "
+                      f"{get('sender_full_name', 'Unknown sender')}{location}: {get('content', '')}")
+            separator = "\n\n"
         
-        return "\n\n".join(formatted_messages)
+        return buf.getvalue()
     
     def _format_conversation_context(self, messages: List[Dict[str, Any]]) -> str:
         """Format conversation messages for context."""
-        formatted_messages = []
-        
-        # Sort messages by timestamp
-        sorted_messages = sorted(messages, key=lambda x: x.get('timestamp', 0))
-        
-        for msg in sorted_messages:
-            sender = msg.get('sender_full_name', 'Unknown sender')
-            content = msg.get('content', '')
-            timestamp = msg.get('timestamp', 'Unknown time')
-            
-            formatted_messages.append(f"{sender} [{timestamp}]: {content}")
+        # Zulip already returns messages oldest first; only sort when that doesn't hold
+        if any(messages[i].get('timestamp', 0) > messages[i + 1].get('timestamp', 0)
+               for i in range(len(messages) - 1)):
+            messages = sorted(messages, key=lambda x: x.get('timestamp', 0))
         
-        return "\n".join(formatted_messages)
\ No newline at end of file
+        return "\n".join(
+            f"{msg.get('sender_full_name', 'Unknown sender')} "
+            f"[{msg.get('timestamp', 'Unknown time')}]: {msg.get('content', '')}"
+            for msg in messages
+        )
\ No newline at end of file
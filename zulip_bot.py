@@ -1,7 +1,9 @@
 import os
 import logging
-from typing import List, Dict, Any, Optional
+import time
+from typing import List, Dict, Any, Optional, Tuple
 from datetime import datetime
+from collections import defaultdict
 import json
 
 from database import BotDatabase
@@ -9,112 +11,130 @@ from zulip_client import ZulipClient
 from vertex_ai_client import VertexAIClient
 
 class ZulipBot:
+    # Seconds the grouped recent conversations are reused across features
+    CONVERSATIONS_CACHE_TTL = 60
+    
     def __init__(self, zulip_email: str, zulip_api_key: str, zulip_site: str, 
                  gcp_project: str, gcp_location: str, 
                  vertex_model: str = "gemini-1.5-pro", style_instructions: Optional[str] = None,
-                 channel_filter: Optional[str] = None):
+                 channel_filter: Optional[str] = None, vertex_concurrency: int = 8,
+                 draft_only_when_needed: bool = True):
         self.db = BotDatabase()
         self.zulip = ZulipClient(zulip_email, zulip_api_key, zulip_site)
-        self.ai = VertexAIClient(gcp_project, gcp_location, vertex_model, style_instructions)
+        self.ai = VertexAIClient(gcp_project, gcp_location, vertex_model, style_instructions,
+                                 cache=self.db, max_concurrency=vertex_concurrency)
         self.user_id = self.zulip.user_id
         self.channel_filter = channel_filter
+        # Only draft for threads where the user was mentioned and hasn't replied yet
+        self.draft_only_when_needed = draft_only_when_needed
         self.logger = logging.getLogger(__name__)
+        # Recent conversations grouped by thread, filled by _get_recent_conversations
+        self._conversations: Optional[Dict[str, Tuple[List[Dict[str, Any]], Dict[str, Any]]]] = None
+        self._conversations_fetched_at = 0.0
         
         # Get user's full name for AI context
         self.user_name = self._get_user_name()
     
     def _get_user_name(self) -> str:
-        """Get the user's full name from Zulip."""
-        try:
-            result = self.zulip.client.get_profile()
-            if result['result'] == 'success':
-                return result.get('full_name', 'User')
-            else:
-                self.logger.error(f"Failed to get user profile: {result.get('msg', 'Unknown error')}")
-                return os.getenv('USER_FULL_NAME', 'User')
-        except Exception as e:
-            self.logger.error(f"Error getting user name: {e}")
-            return os.getenv('USER_FULL_NAME', 'User')
+        """Get the user's full name from the profile fetched by ZulipClient."""
+        return self.zulip.full_name or os.getenv('USER_FULL_NAME', 'User')
     
     def process_unread_messages_and_create_drafts(self):
-        """Feature 1: Fetch all recent messages and create/update drafts for all conversations."""
-        self.logger.info("Processing all recent conversations and creating drafts...")
+        """Feature 1: Fetch all recent messages and create/update drafts for conversations awaiting a reply.
         
-        # Get all recent messages (not just unread)
-        all_recent_messages = self.zulip.get_all_recent_messages(channel_filter=self.channel_filter)
+        By default only private conversations where someone else wrote last and
+        stream threads that mention the user after their last message get a
+        draft. With draft_only_when_needed=False (BOT_DRAFT_ONLY_WHEN_NEEDED=false)
+        every conversation is drafted.
+        """
+        self.logger.info("Processing all recent conversations and creating drafts...")
         
-        # Skip private messages if we're filtering by channel
+        # Private messages are skipped if we're filtering by channel
         if self.channel_filter:
-            all_messages = all_recent_messages
-            self.logger.info(f"Filtering to channel: {self.channel_filter}")
-        else:
-            all_private_messages = self.zulip.get_all_private_messages()
-            all_messages = all_recent_messages + all_private_messages
+            self.logger.info("Filtering to channel: %s", self.channel_filter)
         
-        # Group messages by conversation thread
-        conversations = self._group_messages_by_conversation(all_messages)
+        # Get all recent messages (not just unread), grouped by conversation thread
+        conversations = self._get_recent_conversations()
         
-        for thread_key, messages in conversations.items():
-            if not messages:
+        # Collect the conversations that need a fresh draft
+        pending = []
+        for thread_key, (messages, latest_message) in conversations.items():
+            # Keep the existing draft unless the thread has messages newer than
+            # the ones it was made from
+            last_drafted_id = self.db.get_thread_last_drafted_message_id(thread_key)
+            if last_drafted_id is not None and last_drafted_id >= latest_message['id']:
+                self.logger.debug("Skipping %s - already have draft and no new messages", thread_key)
                 continue
-                
-            latest_message = max(messages, key=lambda x: x['timestamp'])
-            
-            # Check if we already have a draft for this conversation
-            existing_thread = self.db.get_conversation_thread(thread_key)
             
-            # Skip if we already have a draft and no new messages since then
-            if existing_thread and existing_thread.get('draft_id'):
-                existing_last_message_id = existing_thread.get('last_message_id')
-                if existing_last_message_id and existing_last_message_id >= latest_message['id']:
-                    self.logger.debug(f"Skipping {thread_key} - already have draft and no new messages")
-                    continue
+            # Get conversation context from the fetched messages
+            conversation_messages = self._get_conversation_context(messages)
             
-            # Get full conversation context
-            conversation_messages = self._get_conversation_context(messages[0])
+            # The reply check is cheap; skip the AI call for threads that don't need one
+            if self.draft_only_when_needed and not self._needs_draft(conversation_messages):
+                self.logger.debug("Skipping %s - no reply needed", thread_key)
+                continue
             
-            # Generate reply using AI
+            # Build the context for the AI reply
             context_text = self.ai._format_conversation_context(conversation_messages)
+            
             conversation_type = "stream" if messages[0].get('type') == 'stream' else "private"
             
-            reply_content = self.ai.generate_reply(context_text, self.user_name, conversation_type)
+            pending.append((thread_key, messages, latest_message,
+                            (context_text, self.user_name, conversation_type)))
+        
+        # Reply generation is network-bound, so the AI calls run concurrently
+        replies = self.ai.generate_replies_batch([item[3] for item in pending])
+        
+        # Create all drafts with a single request
+        drafted = []
+        draft_payloads = []
+        for (thread_key, messages, latest_message, _), reply_content in zip(pending, replies):
+            if not reply_content:
+                continue
+            draft_payload = self._build_draft(messages[0], reply_content)
+            if draft_payload:
+                drafted.append((thread_key, latest_message))
+                draft_payloads.append(draft_payload)
+        
+        draft_ids = self.zulip.create_drafts_bulk(draft_payloads) if draft_payloads else []
+        
+        # Database rows are collected here and written in bulk
+        processed_rows = []
+        thread_rows = []
+        for (thread_key, latest_message), draft_id in zip(drafted, draft_ids):
+            if not draft_id:
+                self.logger.warning("Failed to create draft for conversation: %s", thread_key)
+                continue
             
-            if reply_content:
-                # Create draft message
-                draft_id = self._create_draft(messages[0], reply_content)
-                
-                if draft_id:
-                    # Mark message as processed
-                    self.db.mark_message_processed(
-                        latest_message['id'],
-                        latest_message.get('stream_id'),
-                        latest_message.get('subject'),
-                        latest_message['sender_id'],
-                        str(latest_message['timestamp']),
-                        draft_created=True
-                    )
-                    
-                    # Update conversation thread
-                    stream_id = latest_message.get('stream_id')
-                    topic = latest_message.get('subject')
-                    self.db.update_conversation_thread(
-                        thread_key, stream_id, topic,
-                        latest_message['id'], str(latest_message['timestamp']),
-                        needs_reply=True, draft_id=draft_id
-                    )
-                    
-                    self.logger.info(f"Created draft for conversation: {thread_key}")
-                else:
-                    self.logger.warning(f"Failed to create draft for conversation: {thread_key}")
+            stream_id = latest_message.get('stream_id')
+            topic = latest_message.get('subject')
+            timestamp = str(latest_message['timestamp'])
+            
+            # Mark message as processed
+            processed_rows.append((
+                latest_message['id'], stream_id, topic,
+                latest_message['sender_id'], timestamp, True
+            ))
+            
+            # Update conversation thread
+            thread_rows.append((
+                thread_key, stream_id, topic, latest_message['id'], timestamp,
+                True, draft_id, latest_message['id']
+            ))
+            
+            self.logger.info("Created draft for conversation: %s", thread_key)
+        
+        self.db.mark_messages_processed_bulk(processed_rows)
+        self.db.update_conversation_threads_bulk(thread_rows)
+        self.db.flush_sync()
     
     def generate_unread_summary(self) -> str:
         """Feature 2: Generate summary of unread messages and post to johannes_bot channel."""
         self.logger.info("Generating unread messages summary...")
         
         # Get all unread messages (excluding johannes_bot channel to avoid self-reference)
-        unread_mentions = self.zulip.get_unread_messages(channel_filter=None)  # Get from all channels
-        unread_privates = self.zulip.get_private_messages()
-        all_unread = unread_mentions + unread_privates
+        # The is:unread narrow already covers private messages, so one request suffices
+        all_unread = self.zulip.get_all_unread()
         
         # Filter out messages from johannes_bot channel to avoid summarizing our own summaries
         filtered_unread = [msg for msg in all_unread if msg.get('display_recipient') != 'johannes_bot']
@@ -134,7 +154,7 @@ class ZulipBot:
         success = self.zulip.send_message("johannes_bot", topic, summary)
         
         if success:
-            self.logger.info(f"Posted summary to johannes_bot channel in topic: {topic}")
+            self.logger.info("Posted summary to johannes_bot channel in topic: %s", topic)
             return f"Summary posted to johannes_bot channel in topic: {topic}"
         else:
             self.logger.error("Failed to post summary to johannes_bot channel")
@@ -145,82 +165,114 @@ class ZulipBot:
         self.logger.info("Checking for open conversations requiring replies...")
         
         # Get all recent messages to check for conversations
-        all_recent_messages = self.zulip.get_all_recent_messages(channel_filter=self.channel_filter)
+        conversations = self._get_recent_conversations()
         
-        if self.channel_filter:
-            all_messages = all_recent_messages
-        else:
-            all_private_messages = self.zulip.get_all_private_messages()
-            all_messages = all_recent_messages + all_private_messages
-        conversations = self._group_messages_by_conversation(all_messages)
-        
-        for thread_key, messages in conversations.items():
-            if not messages:
-                continue
-            
-            # Get full conversation to check if reply is needed
-            conversation_messages = self._get_conversation_context(messages[0])
+        thread_rows = []
+        for thread_key, (messages, latest_message) in conversations.items():
+            # Get the conversation to check if reply is needed
+            conversation_messages = self._get_conversation_context(messages)
             
             needs_reply = self.zulip.needs_reply_in_thread(conversation_messages)
             
             if needs_reply:
-                latest_message = max(conversation_messages, key=lambda x: x['timestamp'])
                 stream_id = latest_message.get('stream_id')
                 topic = latest_message.get('subject')
                 
-                # Update database to track this conversation
-                self.db.update_conversation_thread(
+                # Track this conversation; rows are written in one batch below
+                thread_rows.append((
                     thread_key, stream_id, topic,
                     latest_message['id'], str(latest_message['timestamp']),
-                    needs_reply=True
-                )
+                    True, None, None
+                ))
                 
-                self.logger.info(f"Found conversation needing reply: {thread_key}")
+                self.logger.info("Found conversation needing reply: %s", thread_key)
+        
+        self.db.update_conversation_threads_bulk(thread_rows)
+        self.db.flush_sync()
     
-    def _group_messages_by_conversation(self, messages: List[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
-        """Group messages by conversation thread."""
-        conversations = {}
+    def _get_recent_conversations(self) -> Dict[str, Tuple[List[Dict[str, Any]], Dict[str, Any]]]:
+        """Fetch recent messages grouped by conversation thread.
+        
+        The grouping is reused for CONVERSATIONS_CACHE_TTL seconds, so features
+        run back to back (as in run-all) fetch and group the messages once.
+        """
+        if (self._conversations is not None
+                and time.monotonic() - self._conversations_fetched_at < self.CONVERSATIONS_CACHE_TTL):
+            return self._conversations
+        
+        all_messages = self.zulip.get_all_recent_messages(channel_filter=self.channel_filter)
+        
+        # Skip private messages if we're filtering by channel
+        if not self.channel_filter:
+            all_messages = all_messages + self.zulip.get_all_private_messages()
+        
+        self._conversations = self._group_messages_by_conversation(all_messages)
+        self._conversations_fetched_at = time.monotonic()
+        return self._conversations
+    
+    def _needs_draft(self, conversation_messages: List[Dict[str, Any]]) -> bool:
+        """Check whether a conversation is waiting on a reply from the user.
+        
+        Stream threads need one when the user was mentioned after their last
+        message. Private conversations are addressed to the user, so they need
+        one whenever someone else wrote the latest message.
+        """
+        latest = conversation_messages[-1]
+        if latest.get('type') == 'private':
+            return latest['sender_id'] != self.user_id
+        return self.zulip.needs_reply_in_thread(conversation_messages)
+    
+    def _group_messages_by_conversation(
+            self, messages: List[Dict[str, Any]]
+    ) -> Dict[str, Tuple[List[Dict[str, Any]], Dict[str, Any]]]:
+        """Group messages by conversation thread.
+        
+        Returns thread_key -> (messages, latest message), tracking the latest
+        message in the same pass.
+        """
+        # thread_key -> [messages, latest message]; one dict lookup per message
+        conversations = defaultdict(lambda: [[], None])
         
         for msg in messages:
-            thread_key = self._get_thread_key(msg)
-            if thread_key not in conversations:
-                conversations[thread_key] = []
-            conversations[thread_key].append(msg)
+            entry = conversations[self._get_thread_key(msg)]
+            entry[0].append(msg)
+            if entry[1] is None or msg['timestamp'] > entry[1]['timestamp']:
+                entry[1] = msg
         
-        return conversations
+        return {thread_key: (msgs, latest) for thread_key, (msgs, latest) in conversations.items()}
     
     def _get_thread_key(self, message: Dict[str, Any]) -> str:
         """Generate a unique key for a conversation thread."""
         if message.get('type') == 'stream':
-            return f"stream_{message.get('stream_id')}_{message.get('subject', '')}"
+            # Stream messages always carry stream_id
+            return f"stream_{message['stream_id']}_{message.get('subject', '')}"
         else:
             # For private messages, create key based on participants
             recipients = message.get('display_recipient', [])
             if isinstance(recipients, list):
-                recipient_ids = sorted([r.get('id') for r in recipients if r.get('id') != self.user_id])
-                return f"private_{'_'.join(map(str, recipient_ids))}"
+                uid = self.user_id
+                recipient_ids = sorted(r['id'] for r in recipients if r['id'] != uid)
+                return f"private_{'_'.join(str(i) for i in recipient_ids)}"
             else:
                 return f"private_{message.get('sender_id', 'unknown')}"
     
-    def _get_conversation_context(self, sample_message: Dict[str, Any], 
+    def _get_conversation_context(self, messages: List[Dict[str, Any]], 
                                  context_limit: int = 20) -> List[Dict[str, Any]]:
-        """Get full conversation context for a message."""
-        if sample_message.get('type') == 'stream':
-            return self.zulip.get_thread_messages(
-                sample_message['stream_id'], 
-                sample_message['subject'],
-                num_before=context_limit
-            )
-        else:
-            # For private messages, we'd need to implement a method to get the conversation
-            # For now, return the sample message
-            return [sample_message]
+        """Get conversation context from a thread's already-fetched messages.
+        
+        The recent-message fetch is bucketed by thread, so each bucket already
+        holds the thread's latest messages and no per-thread request is needed.
+        Private messages can appear in both the recent and private fetches, so
+        duplicates are dropped by ID.
+        """
+        unique_messages = {msg['id']: msg for msg in messages}
+        return sorted(unique_messages.values(), key=lambda x: x['id'])[-context_limit:]
     
-    def _create_draft(self, message: Dict[str, Any], content: str) -> Optional[int]:
-        """Create a draft message."""
+    def _build_draft(self, message: Dict[str, Any], content: str) -> Optional[Dict[str, Any]]:
+        """Build the draft payload replying to a message's conversation."""
         # Always create a new draft (no checking for existing ones)
         if message.get('type') == 'stream' and 'stream_id' in message and 'subject' in message:
-            return self.zulip.create_draft(
+            return self.zulip.build_draft(
                 'stream',
                 [],
                 message['subject'],
@@ -229,19 +281,24 @@ class ZulipBot:
             )
         else:
             # For private messages or messages missing required stream fields
-            self.logger.debug(f"Treating as private message. Type: {message.get('type')}, has stream_id: {'stream_id' in message}, has subject: {'subject' in message}")
+            self.logger.debug(
+                "Treating as private message. Type: %s, has stream_id: %s, has subject: %s",
+                message.get('type'), 'stream_id' in message, 'subject' in message)
             recipients = message.get('display_recipient', [])
             if isinstance(recipients, list):
-                recipient_ids = [r.get('id') for r in recipients if r.get('id') != self.user_id]
+                uid = self.user_id
+                recipient_ids = [r['id'] for r in recipients if r['id'] != uid]
                 if recipient_ids:
-                    return self.zulip.create_draft('private', recipient_ids, '', content)
+                    return self.zulip.build_draft('private', recipient_ids, '', content)
             else:
                 # Single recipient private message
                 sender_id = message.get('sender_id')
                 if sender_id and sender_id != self.user_id:
-                    return self.zulip.create_draft('private', [sender_id], '', content)
+                    return self.zulip.build_draft('private', [sender_id], '', content)
             
-            self.logger.warning(f"Could not create draft for message: type={message.get('type')}, stream_id={'stream_id' in message}, subject={'subject' in message}, recipients={recipients}")
+            self.logger.warning(
+                "Could not create draft for message: type=%s, stream_id=%s, subject=%s, recipients=%s",
+                message.get('type'), 'stream_id' in message, 'subject' in message, recipients)
             return None
     
     def _get_thread_key_from_draft(self, draft: Dict[str, Any]) -> str:
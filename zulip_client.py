@@ -1,27 +1,60 @@
 import zulip
 import os
+import time
 from typing import List, Dict, Any, Optional
 from datetime import datetime
 import logging
 
+try:
+    import orjson
+except ImportError:  # optional speedup; requests' stdlib json decoding is used instead
+    orjson = None
+
+
+def _orjson_response_hook(response, *args, **kwargs):
+    """Make response.json() decode the body with orjson."""
+    response.json = lambda **_: orjson.loads(response.content)
+    return response
+
+
+class _OrjsonZulipClient(zulip.Client):
+    """zulip.Client whose HTTP session decodes JSON responses with orjson."""
+    
+    def ensure_session(self) -> None:
+        if self.session:
+            return
+        super().ensure_session()
+        self.session.hooks['response'].append(_orjson_response_hook)
+
+
 class ZulipClient:
+    # Seconds before the cached stream list is refetched
+    STREAMS_CACHE_TTL = 10 * 60
+    
     def __init__(self, email: str, api_key: str, site: str):
         self.logger = logging.getLogger(__name__)
-        print(email, api_key, site)
-        self.client = zulip.Client(email=email, api_key=api_key, site=site)
-        self.user_id = self._get_current_user_id()
+        self.logger.debug("ZulipClient init email=%s site=%s", email, site)
+        client_class = _OrjsonZulipClient if orjson is not None else zulip.Client
+        self.client = client_class(email=email, api_key=api_key, site=site)
+        # One profile request provides both the user ID and the display name
+        self._profile = self._get_profile()
+        self.user_id = self._profile['user_id']
+        self.full_name: Optional[str] = self._profile.get('full_name')
+        # Streams by ID, filled on first use by _ensure_streams
+        self._streams_by_id: Optional[Dict[int, Dict[str, Any]]] = None
+        self._streams_fetched_at = 0.0
     
-    def _get_current_user_id(self) -> int:
-        """Fetch the current user's ID from Zulip API."""
+    def _get_profile(self) -> Dict[str, Any]:
+        """Fetch the current user's profile from Zulip API."""
         try:
             result = self.client.get_profile()
             if result['result'] == 'success':
-                return result['user_id']
+                return result
             else:
-                self.logger.error(f"Failed to get user profile: {result.get('msg', 'Unknown error')}")
-                raise Exception(f"Failed to get user ID: {result.get('msg', 'Unknown error')}")
+                self.logger.error("Failed to get user profile: %s", result.get('msg', 'Unknown error'))
+                raise Exception(f"Failed to get user profile: {result.get('msg', 'Unknown error')}")
         except Exception as e:
-            self.logger.error(f"Error fetching user ID: {e}")
+            self.logger.error("Error fetching user profile: %s", e)
             raise
     
     def get_unread_messages(self, anchor: str = "newest", num_before: int = 100, 
@@ -48,10 +81,10 @@ class ZulipClient:
             if result['result'] == 'success':
                 return result['messages']
             else:
-                self.logger.error(f"Failed to fetch messages: {result.get('msg', 'Unknown error')}")
+                self.logger.error("Failed to fetch messages: %s", result.get('msg', 'Unknown error'))
                 return []
         except Exception as e:
-            self.logger.error(f"Error fetching unread messages: {e}")
+            self.logger.error("Error fetching unread messages: %s", e)
             return []
     
     def get_private_messages(self, anchor: str = "newest", num_before: int = 100) -> List[Dict[str, Any]]:
@@ -71,12 +104,16 @@ class ZulipClient:
             if result['result'] == 'success':
                 return result['messages']
             else:
-                self.logger.error(f"Failed to fetch private messages: {result.get('msg', 'Unknown error')}")
+                self.logger.error("Failed to fetch private messages: %s", result.get('msg', 'Unknown error'))
                 return []
         except Exception as e:
-            self.logger.error(f"Error fetching private messages: {e}")
+            self.logger.error("Error fetching private messages: %s", e)
             return []
 
+    def get_all_unread(self, anchor: str = "newest", num_before: int = 200) -> List[Dict[str, Any]]:
+        """Fetch all unread messages, stream and private, with a single request."""
+        return self.get_unread_messages(anchor=anchor, num_before=num_before)
+
     def get_all_recent_messages(self, anchor: str = "newest", num_before: int = 500, 
                                channel_filter: Optional[str] = None) -> List[Dict[str, Any]]:
         """Fetch all recent messages (not just unread)."""
@@ -99,10 +136,10 @@ class ZulipClient:
             if result['result'] == 'success':
                 return result['messages']
             else:
-                self.logger.error(f"Failed to fetch recent messages: {result.get('msg', 'Unknown error')}")
+                self.logger.error("Failed to fetch recent messages: %s", result.get('msg', 'Unknown error'))
                 return []
         except Exception as e:
-            self.logger.error(f"Error fetching recent messages: {e}")
+            self.logger.error("Error fetching recent messages: %s", e)
             return []
 
     def get_all_private_messages(self, anchor: str = "newest", num_before: int = 500) -> List[Dict[str, Any]]:
@@ -121,10 +158,10 @@ class ZulipClient:
             if result['result'] == 'success':
                 return result['messages']
             else:
-                self.logger.error(f"Failed to fetch all private messages: {result.get('msg', 'Unknown error')}")
+                self.logger.error("Failed to fetch all private messages: %s", result.get('msg', 'Unknown error'))
                 return []
         except Exception as e:
-            self.logger.error(f"Error fetching all private messages: {e}")
+            self.logger.error("Error fetching all private messages: %s", e)
             return []
     
     def get_thread_messages(self, stream_id: int, topic: str, 
@@ -134,7 +171,7 @@ class ZulipClient:
             # Get stream name from stream ID
             stream_info = self.get_stream_info(stream_id)
             if not stream_info:
-                self.logger.error(f"Could not get stream info for stream_id: {stream_id}")
+                self.logger.error("Could not get stream info for stream_id: %s", stream_id)
                 return []
             
             stream_name = stream_info['name']
@@ -153,17 +190,16 @@ class ZulipClient:
             if result['result'] == 'success':
                 return result['messages']
             else:
-                self.logger.error(f"Failed to fetch thread messages: {result.get('msg', 'Unknown error')}")
+                self.logger.error("Failed to fetch thread messages: %s", result.get('msg', 'Unknown error'))
                 return []
         except Exception as e:
-            self.logger.error(f"Error fetching thread messages: {e}")
+            self.logger.error("Error fetching thread messages: %s", e)
             return []
     
     def create_scheduled_message(self, message_type: str, to: List[str], topic: str, 
                                 content: str, stream_id: Optional[int] = None) -> Optional[int]:
         """Create a scheduled message for 10 years in the future."""
         try:
-            import time
             # Schedule for 10 years in the future
             ten_years_from_now = int(time.time()) + (10 * 365 * 24 * 60 * 60)
             
@@ -188,13 +224,15 @@ class ZulipClient:
             
             if result['result'] == 'success':
                 message_id = result.get('scheduled_message_id')
-                self.logger.info(f"Created scheduled message for 10 years from now with ID: {message_id}")
+                self.logger.info("Created scheduled message for 10 years from now with ID: %s", message_id)
                 return message_id
             else:
-                self.logger.error(f"Failed to create scheduled message: {result.get('msg', 'Unknown error')} - Full response: {result}")
+                self.logger.error(
+                    "Failed to create scheduled message: %s - Full response: %s",
+                    result.get('msg', 'Unknown error'), result)
                 return None
         except Exception as e:
-            self.logger.error(f"Error creating scheduled message: {e}")
+            self.logger.error("Error creating scheduled message: %s", e)
             return None
     
     def update_draft(self, draft_id: int, content: str) -> bool:
@@ -210,10 +248,10 @@ class ZulipClient:
             if result['result'] == 'success':
                 return True
             else:
-                self.logger.error(f"Failed to update draft: {result.get('msg', 'Unknown error')}")
+                self.logger.error("Failed to update draft: %s", result.get('msg', 'Unknown error'))
                 return False
         except Exception as e:
-            self.logger.error(f"Error updating draft: {e}")
+            self.logger.error("Error updating draft: %s", e)
             return False
     
     def get_drafts(self) -> List[Dict[str, Any]]:
@@ -228,47 +266,69 @@ class ZulipClient:
             if result['result'] == 'success':
                 return result.get('drafts', [])
             else:
-                self.logger.error(f"Failed to fetch drafts: {result.get('msg', 'Unknown error')}")
+                self.logger.error("Failed to fetch drafts: %s", result.get('msg', 'Unknown error'))
                 return []
         except Exception as e:
-            self.logger.error(f"Error fetching drafts: {e}")
+            self.logger.error("Error fetching drafts: %s", e)
             return []
     
+    def build_draft(self, message_type: str, to: List[str], topic: str, 
+                    content: str, stream_id: Optional[int] = None) -> Dict[str, Any]:
+        """Build the payload for one draft, as accepted by create_drafts_bulk."""
+        if message_type == 'stream':
+            return {
+                'type': 'stream',
+                'content': content,
+                'to': [stream_id] if stream_id else [],
+                'topic': (topic or '').strip()
+            }
+        else:  # private message
+            return {
+                'type': 'private',
+                'content': content,
+                'to': to or [],
+                'topic': ''  # Private messages don't have a topic
+            }
+    
+    def _validate_draft(self, draft: Dict[str, Any]) -> bool:
+        """Check that a draft payload has the fields its type requires."""
+        if draft.get('type') == 'stream':
+            # Validate required fields for stream drafts
+            if not draft.get('to') or not draft.get('topic'):
+                self.logger.error(
+                    "Missing required fields for stream draft: to=%s, topic='%s'",
+                    draft.get('to'), draft.get('topic'))
+                return False
+        elif not draft.get('to'):
+            # Validate required fields for private drafts
+            self.logger.error("Missing recipients for private draft: to=%s", draft.get('to'))
+            return False
+        return True
+    
     def create_draft(self, message_type: str, to: List[str], topic: str, 
                     content: str, stream_id: Optional[int] = None) -> Optional[int]:
         """Create a draft message."""
+        draft_data = self.build_draft(message_type, to, topic, content, stream_id)
+        return self.create_drafts_bulk([draft_data])[0]
+    
+    def create_drafts_bulk(self, drafts: List[Dict[str, Any]]) -> List[Optional[int]]:
+        """Create several drafts (payloads from build_draft) with a single request.
+        
+        Returns the draft IDs aligned with the input; entries that failed
+        validation or creation are None.
+        """
+        draft_ids: List[Optional[int]] = [None] * len(drafts)
+        valid_indices = [i for i, draft in enumerate(drafts) if self._validate_draft(draft)]
+        if not valid_indices:
+            return draft_ids
+        
         try:
-            if message_type == 'stream':
-                # Validate required fields for stream drafts
-                if not stream_id or not topic or topic.strip() == '':
-                    self.logger.error(f"Missing required fields for stream draft: stream_id={stream_id}, topic='{topic}'")
-                    return None
-                    
-                draft_data = {
-                    'type': 'stream',
-                    'content': content,
-                    'to': [stream_id],
-                    'topic': topic.strip()
-                }
-            else:  # private message
-                # Validate required fields for private drafts
-                if not to or len(to) == 0:
-                    self.logger.error(f"Missing recipients for private draft: to={to}")
-                    return None
-                    
-                draft_data = {
-                    'type': 'private',
-                    'content': content,
-                    'to': to,
-                    'topic': ''  # Private messages don't have a topic
-                }
-            
             # Wrap in 'drafts' array as required by the API
             request_data = {
-                'drafts': [draft_data]
+                'drafts': [drafts[i] for i in valid_indices]
             }
             
-            # Use the direct API call to create draft
+            # Use the direct API call to create drafts
             result = self.client.call_endpoint(
                 url='drafts',
                 method='POST',
@@ -276,21 +336,25 @@ class ZulipClient:
             )
             
             if result['result'] == 'success':
-                # The response contains an array of created drafts
-                draft_ids = result.get('ids', [])
-                if draft_ids:
-                    draft_id = draft_ids[0]
-                    self.logger.info(f"Created draft with ID: {draft_id}")
-                    return draft_id
-                else:
-                    self.logger.error("No draft ID returned in response")
-                    return None
+                # The response contains the IDs of the created drafts, in request order
+                created_ids = result.get('ids', [])
+                if len(created_ids) != len(valid_indices):
+                    self.logger.error(
+                        "Expected %s draft IDs, got %s - Full response: %s",
+                        len(valid_indices), len(created_ids), result)
+                    return draft_ids
+                
+                for i, draft_id in zip(valid_indices, created_ids):
+                    draft_ids[i] = draft_id
+                self.logger.info("Created %s draft(s) with IDs: %s", len(created_ids), created_ids)
             else:
-                self.logger.error(f"Failed to create draft {request_data}: {result.get('msg', 'Unknown error')} - Full response: {result}")
-                return None
+                self.logger.error(
+                    "Failed to create drafts %s: %s - Full response: %s",
+                    request_data, result.get('msg', 'Unknown error'), result)
         except Exception as e:
-            self.logger.error(f"Error creating draft: {e}")
-            return None
+            self.logger.error("Error creating drafts: %s", e)
+        
+        return draft_ids
 
     def delete_draft(self, draft_id: int) -> bool:
         """Delete a draft."""
@@ -304,10 +368,10 @@ class ZulipClient:
             if result['result'] == 'success':
                 return True
             else:
-                self.logger.error(f"Failed to delete draft: {result.get('msg', 'Unknown error')}")
+                self.logger.error("Failed to delete draft: %s", result.get('msg', 'Unknown error'))
                 return False
         except Exception as e:
-            self.logger.error(f"Error deleting draft: {e}")
+            self.logger.error("Error deleting draft: %s", e)
             return False
     
     def send_message(self, stream_name: str, topic: str, content: str) -> bool:
@@ -323,10 +387,10 @@ class ZulipClient:
             if result['result'] == 'success':
                 return True
             else:
-                self.logger.error(f"Failed to send message: {result.get('msg', 'Unknown error')}")
+                self.logger.error("Failed to send message: %s", result.get('msg', 'Unknown error'))
                 return False
         except Exception as e:
-            self.logger.error(f"Error sending message: {e}")
+            self.logger.error("Error sending message: %s", e)
             return False
     
     def mark_as_read(self, message_ids: List[int]) -> bool:
@@ -335,49 +399,53 @@ class ZulipClient:
             result = self.client.mark_all_as_read()
             return result['result'] == 'success'
         except Exception as e:
-            self.logger.error(f"Error marking messages as read: {e}")
+            self.logger.error("Error marking messages as read: %s", e)
             return False
     
-    def get_stream_info(self, stream_id: int) -> Optional[Dict[str, Any]]:
-        """Get information about a stream."""
+    def _ensure_streams(self) -> Dict[int, Dict[str, Any]]:
+        """Return the streams indexed by ID, refetching once the cache is older than STREAMS_CACHE_TTL."""
+        if (self._streams_by_id is not None
+                and time.monotonic() - self._streams_fetched_at < self.STREAMS_CACHE_TTL):
+            return self._streams_by_id
+        
         try:
             result = self.client.get_streams()
             if result['result'] == 'success':
-                for stream in result['streams']:
-                    if stream['stream_id'] == stream_id:
-                        return stream
-                return None
+                self._streams_by_id = {stream['stream_id']: stream for stream in result['streams']}
+                self._streams_fetched_at = time.monotonic()
+                return self._streams_by_id
             else:
-                return None
+                self.logger.error("Failed to fetch streams: %s", result.get('msg', 'Unknown error'))
         except Exception as e:
-            self.logger.error(f"Error getting stream info: {e}")
-            return None
+            self.logger.error("Error fetching streams: %s", e)
+        # Serve a stale list over nothing; a failed fetch is retried on the next call
+        return self._streams_by_id or {}
+    
+    def get_stream_info(self, stream_id: int) -> Optional[Dict[str, Any]]:
+        """Get information about a stream."""
+        return self._ensure_streams().get(stream_id)
     
     def needs_reply_in_thread(self, messages: List[Dict[str, Any]]) -> bool:
-        """Check if the user needs to reply in a thread."""
-        if not messages:
-            return False
-        
-        # Sort messages by timestamp
-        sorted_messages = sorted(messages, key=lambda x: x['timestamp'])
+        """Check if the user needs to reply in a thread.
         
-        # Check if the user was mentioned and hasn't replied since
-        user_mentioned = False
-        user_last_reply = None
+        Expects messages oldest first, as Zulip returns them, and scans from the
+        newest message back until both the user's last reply and last mention
+        are found.
+        """
+        uid = self.user_id
         last_mention = None
+        user_last_reply = None
         
-        for msg in sorted_messages:
-            if msg['sender_id'] == self.user_id:
+        for msg in reversed(messages):
+            if user_last_reply is None and msg['sender_id'] == uid:
                 user_last_reply = msg['timestamp']
             
             # Check if user was mentioned in this message
-            if 'mentions' in msg and any(mention['id'] == self.user_id for mention in msg['mentions']):
-                user_mentioned = True
+            if last_mention is None and any(mention['id'] == uid for mention in msg.get('mentions', ())):
                 last_mention = msg['timestamp']
+            
+            if last_mention is not None and user_last_reply is not None:
+                break
         
         # User needs to reply if they were mentioned and haven't replied since the mention
-        if user_mentioned and last_mention:
-            if user_last_reply is None or user_last_reply < last_mention:
-                return True
-        
-        return False
\ No newline at end of file
+        return last_mention is not None and (user_last_reply is None or user_last_reply < last_mention)
\ No newline at end of file